@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import sys
+
+import httpx
+import orjson
+from cachetools import TLRUCache, TTLCache
+
+# -----------------------------------
+# CONFIG
+# -----------------------------------
+
+# Cache lifetimes (seconds)
+QUOTE_TTL = 5            # live prices
+CLOSED_MARKET_TTL = 300  # marketState == "CLOSED": price won't move
+CRYPTO_TTL = 30          # crypto trades around the clock
+STOOQ_TTL = 300          # Stooq fallback quotes are delayed anyway
+BAD_SYMBOL_TTL = 60      # neither Yahoo nor Stooq knows the symbol
+YAHOO_MISS_TTL = 600     # Yahoo has no data: go straight to Stooq
+LAST_PRICE_TTL = 3600    # how stale a price can be served during outages
+
+# Any single Redis round-trip (see set_shared_cache); a slow or hung Redis
+# costs a lookup at most this much before it counts as a miss
+SHARED_CACHE_TIMEOUT = 0.25  # seconds
+
+
+# -----------------------------------
+# TASK HELPERS
+# -----------------------------------
+
+def cancel_quietly(task: asyncio.Task):
+    # Cancel a task we no longer need and swallow whatever it ends with.
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+# -----------------------------------
+# TTL CACHES
+# -----------------------------------
+
+def _chart_ttu(_symbol, chart, now):
+    if chart.get("marketState") == "CLOSED":
+        return now + CLOSED_MARKET_TTL
+    return now + QUOTE_TTL
+
+
+CHART_CACHE = TLRUCache(maxsize=2048, ttu=_chart_ttu)
+STOOQ_CACHE = TTLCache(maxsize=2048, ttl=STOOQ_TTL)
+CRYPTO_CACHE = TTLCache(maxsize=512, ttl=CRYPTO_TTL)
+
+# Negative caches: membership is all that matters
+BAD_SYMBOLS = TTLCache(maxsize=4096, ttl=BAD_SYMBOL_TTL)   # (symbol, asset_type)
+YAHOO_MISSES = TTLCache(maxsize=2048, ttl=YAHOO_MISS_TTL)  # symbol
+
+# Last good price response per (symbol, asset_type), for stale-on-error
+LAST_PRICES = TTLCache(maxsize=2048, ttl=LAST_PRICE_TTL)
+
+
+# -----------------------------------
+# SHARED SECOND LEVEL (REDIS)
+# -----------------------------------
+
+_shared = None  # redis.asyncio client, or None for in-process only
+_MISSING = object()
+# Background writes in flight (held so they aren't garbage collected)
+_shared_writes = set()
+
+
+def set_shared_cache(redis):
+    """
+    Put `redis` (a redis.asyncio client) behind every ttl_cached cache,
+    or pass None to go back to in-process caching only.
+    """
+    global _shared
+    _shared = redis
+
+
+def _entry_ttl(cache, key, value) -> float:
+    if isinstance(cache, TLRUCache):
+        return cache.ttu(key, value, 0)
+    return cache.ttl
+
+
+async def _shared_get(name: str):
+    # Redis trouble, timeouts and undecodable entries all count as a miss
+    if _shared is None:
+        return _MISSING
+    try:
+        body = await asyncio.wait_for(_shared.get(name), SHARED_CACHE_TIMEOUT)
+        return _MISSING if body is None else orjson.loads(body)
+    except Exception:
+        return _MISSING
+
+
+async def _shared_write(redis, name: str, value, ttl: float):
+    try:
+        await asyncio.wait_for(
+            redis.set(name, orjson.dumps(value), px=max(1, int(ttl * 1000))),
+            SHARED_CACHE_TIMEOUT,
+        )
+    except Exception:
+        pass
+
+
+def _shared_put(name: str, value, ttl: float):
+    # Written in the background so callers never wait on Redis
+    if _shared is None:
+        return
+    task = asyncio.create_task(_shared_write(_shared, name, value, ttl))
+    _shared_writes.add(task)
+    task.add_done_callback(_shared_writes.discard)
+
+
+def cache_key(symbol: str, *params):
+    """
+    Canonical cache key: upper-cased symbol, plus any extra positional
+    arguments (range, interval, ...). Tickers and coin ids are
+    case-insensitive upstream, so "aapl" and "AAPL" share an entry;
+    the symbol is interned so every key for it shares one string.
+    """
+    symbol = sys.intern(symbol.upper())
+    return (symbol, *params) if params else symbol
+
+
+def ttl_cached(cache, key=cache_key):
+    """
+    Cache an async fetcher's result in `cache` under key(symbol, *params),
+    cache_key() by default.
+    Concurrent misses for the same symbol share one upstream call
+    (single-flight); that call is only cancelled once every caller
+    waiting on it has gone away.
+    Only successful results are stored; errors always go upstream.
+
+    With a shared cache set (set_shared_cache), a local miss checks
+    Redis before fetching, and fresh results are written there with the
+    entry's TTL. A value taken from Redis gets a full local TTL, so it
+    can be served up to twice the TTL after it was fetched.
+
+    The wrapped fetcher gains a `refresh(client, symbol, *params)`
+    coroutine that re-fetches into the cache while the old entry keeps
+    serving, joining any fetch already in flight for that key.
+    """
+    def decorator(fetch):
+        make_key = key
+        inflight = {}  # key -> [task, number of waiters]
+        prefix = f"ttl:{fetch.__module__}.{fetch.__qualname__}:"
+
+        async def fill(key, client, symbol, params, check_shared):
+            name = prefix + repr(key)
+            if check_shared:
+                value = await _shared_get(name)
+                if value is not _MISSING:
+                    cache[key] = value
+                    return value
+
+            value = await fetch(client, symbol, *params)
+            cache[key] = value
+            _shared_put(name, value, _entry_ttl(cache, key, value))
+            return value
+
+        def land(key, task):
+            if key in inflight and inflight[key][0] is task:
+                del inflight[key]
+
+        async def fly(key, client, symbol, params, check_shared=True):
+            flight = inflight.get(key)
+            if flight is None:
+                task = asyncio.create_task(
+                    fill(key, client, symbol, params, check_shared)
+                )
+                task.add_done_callback(functools.partial(land, key))
+                flight = inflight[key] = [task, 0]
+
+            task = flight[0]
+            flight[1] += 1
+            try:
+                return await asyncio.shield(task)
+            finally:
+                flight[1] -= 1
+                if flight[1] == 0 and not task.done():
+                    land(key, task)
+                    cancel_quietly(task)
+
+        @functools.wraps(fetch)
+        async def wrapper(client: httpx.AsyncClient, symbol: str, *params):
+            key = make_key(symbol, *params)
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            return await fly(key, client, symbol, params)
+
+        async def refresh(client: httpx.AsyncClient, symbol: str, *params):
+            key = make_key(symbol, *params)
+            return await fly(key, client, symbol, params, check_shared=False)
+
+        wrapper.refresh = refresh
+        return wrapper
+    return decorator
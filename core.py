@@ -1,26 +1,387 @@
-import requests
+import asyncio
+import functools
+import string
+import time
+from email.utils import parsedate_to_datetime
 from urllib.parse import quote
 
+import httpx
+import orjson
+
+from cache import (
+    CHART_CACHE,
+    STOOQ_CACHE,
+    CRYPTO_CACHE,
+    cancel_quietly,
+    ttl_cached,
+)
+
 # -----------------------------------
 # CONFIG
 # -----------------------------------
 
 HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    # Upstreams are JSON APIs; /proxy may still get CSV or text back
+    "Accept": "application/json, text/plain;q=0.9, */*;q=0.8",
 }
 
 TIMEOUT = 10  # seconds
+CONNECT_TIMEOUT = 3  # seconds; fail fast to the hedge/fallback
+# Per-provider socket timeouts (each connect/read/write, not the whole call)
+PRIMARY_TIMEOUT = httpx.Timeout(3.0, connect=CONNECT_TIMEOUT)   # Yahoo
+FALLBACK_TIMEOUT = httpx.Timeout(5.0, connect=CONNECT_TIMEOUT)  # Stooq, CoinGecko
+# Overall budget for one provider call, hedging and reconnects included,
+# so one stalled upstream can't hold a lookup for long (see circuit_breaker)
+PRIMARY_DEADLINE = 3.0   # seconds; Yahoo
+FALLBACK_DEADLINE = 5.0  # seconds; Stooq, CoinGecko
+# Idle pooled connections live this long (httpx default: 5s), so sporadic
+# traffic doesn't redo DNS + TCP + TLS setup on every request.
+KEEPALIVE_EXPIRY = 60  # seconds
+# Bodies larger than this are parsed off the event loop. Today's fetches
+# (3-month daily charts, ~10KB) stay well under it and parse inline; it
+# only matters for long-range or intraday charts.
+LARGE_PAYLOAD_BYTES = 64 * 1024
+
+# Upstream retry policy for GETs (see RetryTransport)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5     # seconds, doubled each attempt
+RETRY_MAX_WAIT = 4.0    # a longer Retry-After is handed back, not waited out
+# Request extension that turns RetryTransport off. The price lookups send
+# it: they have their own fallbacks (hedged mirror, Stooq) and retrying a
+# host that is already rate-limiting only makes things worse.
+NO_RETRY = {"retry": False}
+
+# Yahoo serves the same API from two hosts; the first is primary and
+# the second is only hit once the primary has had HEDGE_DELAY to answer.
+YAHOO_HOSTS = ("query2.finance.yahoo.com", "query1.finance.yahoo.com")
+HEDGE_DELAY = 0.5  # seconds
+MIRROR_MAX_BACKOFF = 60  # seconds a failing mirror can be benched for
+
+# Per-provider circuit breaker (see circuit_breaker)
+BREAKER_FAIL_MAX = 5        # consecutive transient failures before opening
+BREAKER_RESET_TIMEOUT = 30  # seconds the circuit stays open
+
+# CoinGecko simple/price takes many ids per call; lookups arriving within
+# the window share one request.
+COINGECKO_BATCH_WINDOW = 0.05  # seconds
+COINGECKO_BATCH_MAX = 50  # ids per request
+
+
+# -----------------------------------
+# URL TEMPLATES
+# -----------------------------------
+
+YAHOO_CHART_URL = "https://{}/v8/finance/chart/{}?interval={}&range={}".format
+STOOQ_QUOTE_URL = "https://stooq.com/q/l/?s={}&f=sd2t2ohlcv&h&e=json".format
+COINGECKO_PRICE_URL = (
+    "https://api.coingecko.com/api/v3/simple/price?ids={}&vs_currencies=usd"
+).format
+
+# Characters quote() never escapes
+_QUOTE_SAFE = frozenset(string.ascii_letters + string.digits + "_.-~")
+
+
+def fast_quote(s: str) -> str:
+    """
+    quote(s, safe="") that skips the encoder for plain tickers,
+    which are nearly always already URL-safe.
+    """
+    if _QUOTE_SAFE.issuperset(s):
+        return s
+    return quote(s, safe="")
+
+
+@functools.lru_cache(maxsize=512)
+def yahoo_chart_urls(symbol: str, range_: str, interval: str) -> tuple:
+    """
+    Chart URLs for `symbol` on every host in YAHOO_HOSTS, memoized
+    since the same few symbols are requested over and over.
+    """
+    encoded = fast_quote(symbol)
+    return tuple(YAHOO_CHART_URL(host, encoded, interval, range_) for host in YAHOO_HOSTS)
+
+
+# -----------------------------------
+# SHARED HTTP CLIENT
+# -----------------------------------
+
+def _retry_wait(response: httpx.Response, attempt: int):
+    """
+    Seconds to wait before retrying, from Retry-After when present
+    (delta-seconds or HTTP date), else exponential backoff.
+    None when the wait would exceed RETRY_MAX_WAIT.
+    """
+    wait = RETRY_BACKOFF * (2 ** attempt)
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    wait = max(wait, 0.0)
+    return wait if wait <= RETRY_MAX_WAIT else None
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Retries GETs that come back 429/5xx, honouring Retry-After and
+    otherwise backing off exponentially. Connection failures are
+    retried by the wrapped transport. Requests carrying the NO_RETRY
+    extension are sent once.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            response = await self._transport.handle_async_request(request)
+            if (
+                request.method != "GET"
+                or request.extensions.get("retry") is False
+                or response.status_code not in RETRY_STATUSES
+                or attempt >= RETRY_TOTAL
+            ):
+                return response
+
+            wait = _retry_wait(response, attempt)
+            if wait is None:
+                return response
+
+            await response.aclose()
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class UpstreamError(Exception):
+    """
+    Base for provider failures that aren't HTTP errors.
+    """
+
+
+class NoData(UpstreamError):
+    """
+    The provider answered but has no usable data for the request.
+    """
+
+
+class CircuitOpen(UpstreamError):
+    """
+    Raised instead of calling a provider whose circuit is open.
+    """
+
+
+class DeadlineExceeded(UpstreamError):
+    """
+    A provider call ran past its overall deadline.
+    """
+
+
+# Everything a provider lookup is expected to fail with; anything
+# else is a bug and should surface as one.
+PROVIDER_ERRORS = (UpstreamError, httpx.HTTPError)
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """
+    True for failures worth retrying later (network trouble, 429/5xx,
+    a blown deadline, an open circuit); False when the upstream answered
+    and simply has no data.
+    """
+    if isinstance(exc, (httpx.TransportError, CircuitOpen, DeadlineExceeded)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUSES
+    return False
+
+
+def make_client() -> httpx.AsyncClient:
+    """
+    Build the async client shared by every fetcher.
+    HTTP/2 multiplexes concurrent requests to a host over one
+    connection, so the pool can stay small; hosts that only speak
+    HTTP/1.1 still get pooled keep-alive connections. Hostnames are only
+    resolved when a new connection is opened.
+    GETs are retried on 429/5xx (unless sent with NO_RETRY) and on
+    failed connection attempts. Redirects are followed, as requests did.
+    """
+    limits = httpx.Limits(
+        max_connections=50,
+        max_keepalive_connections=20,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=3)
+    return httpx.AsyncClient(
+        headers=HEADERS,
+        timeout=httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+        transport=RetryTransport(transport),
+        follow_redirects=True,
+    )
+
+
+async def get_json(
+    client: httpx.AsyncClient,
+    url: str,
+    timeout=httpx.USE_CLIENT_DEFAULT,
+    retry: bool = True,
+):
+    """
+    GET url and decode the body with orjson, in a worker thread for
+    bodies over LARGE_PAYLOAD_BYTES so other requests keep being served.
+    retry=False skips RetryTransport's 429/5xx retries.
+    Raises httpx.HTTPStatusError on non-2xx responses and NoData when
+    the body isn't JSON.
+    """
+    r = await client.get(url, timeout=timeout, extensions=None if retry else NO_RETRY)
+    r.raise_for_status()
+    body = r.content
+    try:
+        if len(body) > LARGE_PAYLOAD_BYTES:
+            return await asyncio.to_thread(orjson.loads, body)
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise NoData(f"Invalid JSON from {r.url.host}")
+
+
+# Per-host circuit breaker: host -> [consecutive failures, benched until]
+_mirror_health = {}
+
+
+async def _get_json_tracked(client: httpx.AsyncClient, url: str):
+    host = httpx.URL(url).host
+    try:
+        data = await get_json(client, url, PRIMARY_TIMEOUT, retry=False)
+    except Exception as e:
+        if is_transient_error(e):
+            health = _mirror_health.setdefault(host, [0, 0.0])
+            health[0] += 1
+            health[1] = time.monotonic() + min(MIRROR_MAX_BACKOFF, 2 ** health[0])
+        raise
+    _mirror_health.pop(host, None)
+    return data
+
+
+def _healthy_first(urls) -> list:
+    now = time.monotonic()
+    healthy, benched = [], []
+    for url in urls:
+        health = _mirror_health.get(httpx.URL(url).host)
+        (benched if health and health[1] > now else healthy).append(url)
+    return healthy + benched
+
+
+async def get_json_hedged(client: httpx.AsyncClient, urls) -> dict:
+    """
+    GET the same resource from several mirrors.
+    The first healthy mirror gets a HEDGE_DELAY head start; if it hasn't
+    succeeded by then the rest are fired too, and the first successful
+    JSON body wins. Raises the last error if every mirror fails.
+
+    A mirror that fails transiently is benched for 2**failures seconds
+    (capped at MIRROR_MAX_BACKOFF) and only tried after healthy ones;
+    one success clears its record.
+    """
+    urls = _healthy_first(urls)
+    primary = asyncio.create_task(_get_json_tracked(client, urls[0]))
+    tasks = [primary]
+    try:
+        await asyncio.wait(tasks, timeout=HEDGE_DELAY)
+        if primary.done() and primary.exception() is None:
+            return primary.result()
+
+        tasks += [asyncio.create_task(_get_json_tracked(client, url)) for url in urls[1:]]
+        error = None
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except Exception as e:
+                error = e
+        raise error
+    finally:
+        for task in tasks:
+            cancel_quietly(task)
+
+
+# -----------------------------------
+# PROVIDER CIRCUIT BREAKERS
+# -----------------------------------
+
+# provider -> [consecutive transient failures, open until]
+_breakers = {}
+
+
+def circuit_breaker(provider: str, deadline: float):
+    """
+    Give each call to `provider` at most `deadline` seconds overall
+    (DeadlineExceeded after that), and fail fast with CircuitOpen once
+    it has failed transiently BREAKER_FAIL_MAX times in a row, for
+    BREAKER_RESET_TIMEOUT seconds.
+    When that time is up, calls go through again (every concurrent one,
+    there is no single probe): a success closes the circuit, and any
+    transient failure reopens it straight away. "No data" answers don't
+    count as failures.
+    """
+    def decorator(fetch):
+        @functools.wraps(fetch)
+        async def wrapper(*args):
+            state = _breakers.get(provider)
+            if state is not None and state[1] > time.monotonic():
+                raise CircuitOpen(f"{provider} circuit open")
+            try:
+                try:
+                    result = await asyncio.wait_for(fetch(*args), deadline)
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(
+                        f"{provider} gave no answer within {deadline}s"
+                    ) from None
+            except Exception as e:
+                if is_transient_error(e):
+                    state = _breakers.setdefault(provider, [0, 0.0])
+                    state[0] += 1
+                    if state[0] >= BREAKER_FAIL_MAX:
+                        state[1] = time.monotonic() + BREAKER_RESET_TIMEOUT
+                raise
+            _breakers.pop(provider, None)
+            return result
+        return wrapper
+    return decorator
+
+
+def breaker_states() -> dict:
+    """
+    {provider: {"state", "failures"}} for providers with recent failures.
+    """
+    now = time.monotonic()
+    return {
+        provider: {
+            "state": "open" if open_until > now else "closed",
+            "failures": failures,
+        }
+        for provider, (failures, open_until) in _breakers.items()
+    }
 
 
 # -----------------------------------
 # ASSET TYPE DETECTION
 # -----------------------------------
 
+@functools.lru_cache(maxsize=4096)
 def detect_asset_type(symbol: str) -> str:
-    s = symbol.upper()
-    if s.startswith("^"):
+    """
+    Classify an upper-cased symbol (callers upper-case once up front).
+    """
+    if symbol[:1] == "^":
         return "index"
-    if "=" in s:
+    if "=" in symbol:
         return "future"
     return "stock"  # includes ETFs
 
@@ -29,22 +390,44 @@ def detect_asset_type(symbol: str) -> str:
 # FUTURES / INDEX SYMBOL MAPPING
 # -----------------------------------
 
+# Pure string mappings over a small symbol universe: memoized
+@functools.lru_cache(maxsize=4096)
 def stooq_symbol_for_stock(ticker: str) -> str:
     return ticker.lower() + ".us"
 
+@functools.lru_cache(maxsize=4096)
 def stooq_symbol_for_future(symbol: str) -> str:
     base = symbol.upper().replace("=F", "").lower()
     return base + ".f"
 
+@functools.lru_cache(maxsize=4096)
 def stooq_symbol_for_index(symbol: str) -> str:
     return symbol.lower()
 
 
+STOOQ_SYMBOL_MAPPERS = {
+    "stock": stooq_symbol_for_stock,
+    "future": stooq_symbol_for_future,
+    "index": stooq_symbol_for_index,
+}
+
+
 # -----------------------------------
 # YAHOO CHART API (PRIMARY SOURCE)
 # -----------------------------------
 
-def fetch_yahoo_chart(symbol: str) -> dict:
+# Shared stand-in for missing or null history arrays (serialized as [])
+EMPTY = ()
+
+
+@ttl_cached(CHART_CACHE)
+@circuit_breaker("yahoo", PRIMARY_DEADLINE)
+async def fetch_yahoo_chart(
+    client: httpx.AsyncClient,
+    symbol: str,
+    range_: str = "3mo",
+    interval: str = "1d",
+) -> dict:
     """
     Fetch full chart data from Yahoo Finance:
     - regularMarketPrice
@@ -52,20 +435,15 @@ def fetch_yahoo_chart(symbol: str) -> dict:
     - volume
     - timestamps
     - metadata (exchange, currency, marketState)
-    """
-    encoded = quote(symbol, safe="")
-    url = (
-        f"https://query2.finance.yahoo.com/v8/finance/chart/"
-        f"{encoded}?interval=1d&range=3mo"
-    )
 
-    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-    r.raise_for_status()
-    data = r.json()
+    Price-only callers pass range_="1d" to keep the payload small.
+    Pass range_/interval positionally so they are part of the cache key.
+    """
+    data = await get_json_hedged(client, yahoo_chart_urls(symbol, range_, interval))
 
     result = data.get("chart", {}).get("result")
     if not result:
-        raise Exception("No Yahoo Chart data")
+        raise NoData("No Yahoo Chart data")
 
     chart = result[0]
     meta = chart.get("meta", {})
@@ -81,66 +459,155 @@ def fetch_yahoo_chart(symbol: str) -> dict:
         "currency": meta.get("currency"),
         "marketState": meta.get("marketState"),
 
-        # 90-day history
-        "timestamps": chart.get("timestamp", []),
+        # history for the requested range
+        "timestamps": chart.get("timestamp") or EMPTY,
 
         # OHLC + volume arrays
-        "open": quote_block.get("open", []),
-        "high": quote_block.get("high", []),
-        "low": quote_block.get("low", []),
-        "close": quote_block.get("close", []),
-        "volume": quote_block.get("volume", []),
+        "open": quote_block.get("open") or EMPTY,
+        "high": quote_block.get("high") or EMPTY,
+        "low": quote_block.get("low") or EMPTY,
+        "close": quote_block.get("close") or EMPTY,
+        "volume": quote_block.get("volume") or EMPTY,
     }
 
 
 # -----------------------------------
-# STOOQ FALLBACK (SECONDARY SOURCE)
+# YAHOO MULTI-SYMBOL QUOTES
 # -----------------------------------
 
-def fetch_stooq_quote(symbol: str) -> float:
+async def multi_fetch_yahoo_quote(client: httpx.AsyncClient, symbols: list[str]) -> dict:
     """
-    Fetch last close price from Stooq.
+    Fetch current prices for many symbols via the v8 chart API
+    (range 1d, so each payload is a single bar). Lookups run concurrently
+    and share CHART_CACHE with the single-symbol path; a symbol the
+    provider fails on is just left out, any other error is raised.
+    Returns {symbol: chart}.
     """
-    url = f"https://stooq.com/q/l/?s={symbol}&f=sd2t2ohlcv&h&e=json"
+    results = await asyncio.gather(
+        *(fetch_yahoo_chart(client, symbol, "1d", "1d") for symbol in symbols),
+        return_exceptions=True,
+    )
 
-    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-    r.raise_for_status()
-    data = r.json()
+    charts = {}
+    for symbol, chart in zip(symbols, results):
+        if isinstance(chart, PROVIDER_ERRORS):
+            continue
+        if isinstance(chart, Exception):
+            raise chart
+        charts[symbol] = chart
+    return charts
 
-    if not isinstance(data, list) or not data:
-        raise Exception("Invalid Stooq response")
 
-    row = data[0]
-    close = row.get("close")
-    if not close or close == "N/A":
-        raise Exception("Stooq close unavailable")
+# -----------------------------------
+# STOOQ FALLBACK (SECONDARY SOURCE)
+# -----------------------------------
 
-    return float(close)
+@ttl_cached(STOOQ_CACHE)
+@circuit_breaker("stooq", FALLBACK_DEADLINE)
+async def fetch_stooq_quote(client: httpx.AsyncClient, symbol: str) -> float:
+    """
+    Fetch last close price from Stooq.
+    """
+    url = STOOQ_QUOTE_URL(symbol)
+
+    data = await get_json(client, url, FALLBACK_TIMEOUT, retry=False)
+
+    # One parse covers every bad shape: empty or non-list payload,
+    # missing close, and Stooq's "N/A" placeholder.
+    try:
+        return float(data[0]["close"])
+    except (LookupError, TypeError, ValueError):
+        raise NoData("Stooq close unavailable")
 
 
 # -----------------------------------
 # CRYPTO (COINGECKO)
 # -----------------------------------
 
-def fetch_crypto_price(symbol: str) -> dict:
+@circuit_breaker("coingecko", FALLBACK_DEADLINE)
+async def fetch_coingecko_prices(client: httpx.AsyncClient, coin_ids: list[str]) -> dict:
     """
-    Fetch crypto price from CoinGecko.
+    Fetch USD prices for several CoinGecko ids in one request.
+    Returns {coin_id: price}; ids CoinGecko has no price for are left out.
     """
-    coin_id = symbol.lower()
-    url = (
-        "https://api.coingecko.com/api/v3/simple/price"
-        f"?ids={coin_id}&vs_currencies=usd"
-    )
-
-    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-    r.raise_for_status()
-    data = r.json()
-
-    if coin_id not in data or "usd" not in data[coin_id]:
-        raise Exception("No CoinGecko price")
+    url = COINGECKO_PRICE_URL(",".join(fast_quote(coin_id) for coin_id in coin_ids))
+
+    data = await get_json(client, url, FALLBACK_TIMEOUT, retry=False)
+
+    prices = {}
+    for coin_id in coin_ids:
+        try:
+            prices[coin_id] = float(data[coin_id]["usd"])
+        except (LookupError, TypeError, ValueError):
+            pass
+    return prices
+
+
+# Batch currently collecting ids: (coin_id -> Future[price], Event set
+# once it holds COINGECKO_BATCH_MAX ids)
+_coingecko_batch = None
+# Flush tasks in flight (held so they aren't garbage collected)
+_coingecko_flushes = set()
+
+
+async def _flush_coingecko(client: httpx.AsyncClient, batch: dict, full: asyncio.Event):
+    global _coingecko_batch
+    try:
+        await asyncio.wait_for(full.wait(), COINGECKO_BATCH_WINDOW)
+    except asyncio.TimeoutError:
+        pass
+    if _coingecko_batch is not None and _coingecko_batch[0] is batch:
+        _coingecko_batch = None
+
+    try:
+        prices = await fetch_coingecko_prices(client, list(batch))
+    except Exception as e:
+        error = e
+        prices = {}
+    else:
+        error = NoData("No CoinGecko price")
+
+    for coin_id, future in batch.items():
+        if future.done():  # waiter was cancelled
+            continue
+        if coin_id in prices:
+            future.set_result(prices[coin_id])
+        else:
+            future.set_exception(error)
+
+
+async def _coingecko_price(client: httpx.AsyncClient, coin_id: str) -> float:
+    """
+    Queue coin_id on the current batch (starting one if needed) and
+    wait for its price. A batch is sent after COINGECKO_BATCH_WINDOW,
+    or as soon as it holds COINGECKO_BATCH_MAX ids.
+    """
+    global _coingecko_batch
+    if _coingecko_batch is None:
+        _coingecko_batch = ({}, asyncio.Event())
+        task = asyncio.create_task(_flush_coingecko(client, *_coingecko_batch))
+        _coingecko_flushes.add(task)
+        task.add_done_callback(_coingecko_flushes.discard)
+
+    batch, full = _coingecko_batch
+    future = batch.get(coin_id)
+    if future is None or future.done():  # done: its waiter was cancelled
+        future = batch[coin_id] = asyncio.get_running_loop().create_future()
+        if len(batch) >= COINGECKO_BATCH_MAX:
+            _coingecko_batch = None  # the next id starts a new batch
+            full.set()
+    return await future
+
+
+@ttl_cached(CRYPTO_CACHE)
+async def fetch_crypto_price(client: httpx.AsyncClient, symbol: str) -> dict:
+    """
+    Fetch crypto price from CoinGecko, batched with concurrent lookups.
+    """
+    price = await _coingecko_price(client, symbol.lower())
 
     return {
         "source": "coingecko",
         "symbol": symbol.upper(),
-        "price": float(data[coin_id]["usd"]),
+        "price": price,
     }
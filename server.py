@@ -1,20 +1,42 @@
+import asyncio
+import functools
+import hashlib
+import os
+import random
 import time
-import threading
-from functools import lru_cache
+from collections import Counter
+from contextlib import asynccontextmanager
 from urllib.parse import urlparse
 
-import requests
-from fastapi import FastAPI, Query, Body, HTTPException
+import httpx
+import orjson
+from fastapi import FastAPI, Query, Body, HTTPException, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
 # Import core logic
 from core import (
+    make_client,
+    is_transient_error,
+    PROVIDER_ERRORS,
     fetch_yahoo_chart,
     fetch_stooq_quote,
     fetch_crypto_price,
+    multi_fetch_yahoo_quote,
     detect_asset_type,
-    stooq_symbol_for_stock,
-    stooq_symbol_for_future,
-    stooq_symbol_for_index,
+    breaker_states,
+    STOOQ_SYMBOL_MAPPERS,
+)
+from cache import (
+    CHART_CACHE,
+    BAD_SYMBOLS,
+    YAHOO_MISSES,
+    LAST_PRICES,
+    QUOTE_TTL,
+    SHARED_CACHE_TIMEOUT,
+    cancel_quietly,
+    set_shared_cache,
 )
 
 # -----------------------------------
@@ -22,16 +44,34 @@ from core import (
 # -----------------------------------
 
 SERVICE_BASE_URL = "https://themarket-api.onrender.com"
-
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
-}
+SELF_PING_URL = f"{SERVICE_BASE_URL}/health"
 
 ALLOWED_TIMEOUT = 10
 SELF_PING_INTERVAL = 60
+SELF_PING_JITTER = 5         # +/- seconds, so instances don't ping in lockstep
+SELF_PING_MAX_BACKOFF = 300  # cap on the delay after repeated failures
+# Turn off (SELF_PING=0) where the platform keeps the service awake itself
+SELF_PING = os.getenv("SELF_PING", "1") == "1"
+MAX_BATCH_SYMBOLS = 50
+PROXY_CHUNK_SIZE = 64 * 1024  # bytes per chunk when streaming /proxy?raw=1
+# Lets browsers and any CDN in front reuse price responses briefly
+PRICE_CACHE_CONTROL = "public, max-age=15, stale-while-revalidate=60"
+# Chart arrays compress well; tiny responses aren't worth the CPU
+GZIP_MIN_SIZE = 1024  # bytes
+GZIP_LEVEL = 5
+
+# Refresh-ahead for hot symbols (see refresh_ahead_loop)
+REFRESH_AHEAD_INTERVAL = 2   # seconds between passes
+REFRESH_AHEAD_TOP_K = 20
+REFRESH_AHEAD_MIN_HITS = 2   # decayed hit count for a symbol to count as hot
+REFRESH_AHEAD_MARGIN = 1     # refresh this many seconds before the TTL runs out
+
+# Optional Redis shared by every ttl_cached cache, so workers and restarts
+# share upstream results; unset keeps caching in-process only.
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Whitelisted domains for internal proxy
-WHITELISTED_DOMAINS = {
+WHITELISTED_DOMAINS = frozenset({
     "query1.finance.yahoo.com",
     "query2.finance.yahoo.com",
     "stooq.com",
@@ -39,59 +79,119 @@ WHITELISTED_DOMAINS = {
     "symbol-search.tradingview.com",
     "www.alphavantage.co",
     "finnhub.io",
-}
+})
+
+# -----------------------------------
+# APP LIFESPAN
+# -----------------------------------
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Owns everything long-lived: the shared HTTP client, the optional
+    Redis client and the self-ping / refresh-ahead background tasks.
+    """
+    app.state.client = make_client()
+    app.state.redis = None
+    if REDIS_URL:
+        import redis.asyncio as aioredis
+        app.state.redis = aioredis.from_url(
+            REDIS_URL,
+            decode_responses=False,
+            socket_timeout=SHARED_CACHE_TIMEOUT,
+            socket_connect_timeout=SHARED_CACHE_TIMEOUT,
+        )
+    set_shared_cache(app.state.redis)
+    tasks = [asyncio.create_task(refresh_ahead_loop())]
+    if SELF_PING:
+        tasks.append(asyncio.create_task(self_ping_loop()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await app.state.client.aclose()
+        set_shared_cache(None)
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL)
 
-app = FastAPI()
 
 # -----------------------------------
 # WHITELIST CHECK
 # -----------------------------------
 
+@functools.lru_cache(maxsize=4096)
+def _host_of(url: str) -> str:
+    # The same few provider URLs come through over and over
+    host = urlparse(url).netloc
+    i = host.find(":")
+    return (host[:i] if i >= 0 else host).lower()
+
+
 def _check_whitelist(url: str):
-    parsed = urlparse(url)
-    host = parsed.netloc.lower()
-    if ":" in host:
-        host = host.split(":", 1)[0]
+    host = _host_of(url)
     if host not in WHITELISTED_DOMAINS:
         raise HTTPException(status_code=400, detail=f"Domain not allowed: {host}")
 
 # -----------------------------------
-# CACHED JSON GET
-# -----------------------------------
-
-@lru_cache(maxsize=256)
-def cached_get_json(url: str) -> dict:
-    _check_whitelist(url)
-    r = requests.get(url, headers=HEADERS, timeout=ALLOWED_TIMEOUT)
-    r.raise_for_status()
-    return r.json()
-# -----------------------------------
 # INTERNAL PROXY (GET + POST)
 # -----------------------------------
 
 @app.api_route("/proxy", methods=["GET", "POST"])
-def internal_proxy(
+async def internal_proxy(
     url: str = Query(..., description="Target URL (must be whitelisted)"),
     method: str = Query("GET", description="HTTP method: GET or POST"),
     body: dict | None = Body(default=None),
+    raw: bool = Query(False, description="Stream the upstream body through unchanged"),
 ):
+    """
+    Forward a request to a whitelisted host.
+    By default JSON bodies are returned parsed and anything else as
+    {"status_code", "content"}; with raw=1 the upstream status, type and
+    bytes are streamed through without being buffered.
+    """
     _check_whitelist(url)
     method_upper = method.upper()
+    if method_upper not in ("GET", "POST"):
+        raise HTTPException(status_code=400, detail="Only GET and POST are supported")
+
+    client = app.state.client
+    request = client.build_request(
+        method_upper,
+        url,
+        json=body if method_upper == "POST" else None,
+        timeout=ALLOWED_TIMEOUT,
+    )
 
     try:
-        if method_upper == "GET":
-            r = requests.get(url, headers=HEADERS, timeout=ALLOWED_TIMEOUT)
-        elif method_upper == "POST":
-            r = requests.post(url, json=body, headers=HEADERS, timeout=ALLOWED_TIMEOUT)
-        else:
-            raise HTTPException(status_code=400, detail="Only GET and POST are supported")
-    except requests.RequestException as e:
+        r = await client.send(request, stream=True)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=str(e))
 
     content_type = r.headers.get("Content-Type", "")
+    if raw:
+        return StreamingResponse(
+            r.aiter_bytes(PROXY_CHUNK_SIZE),
+            status_code=r.status_code,
+            media_type=content_type or None,
+            background=BackgroundTask(r.aclose),
+        )
+
+    try:
+        await r.aread()
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        await r.aclose()
+
     if "application/json" in content_type:
         try:
-            return r.json()
+            return orjson.loads(r.content)
         except ValueError:
             pass
 
@@ -103,159 +203,320 @@ def internal_proxy(
 # -----------------------------------
 
 @app.get("/health")
-def health():
-    return {"status": "ok"}
+async def health():
+    # "circuits" lists providers with recent failures (see core.circuit_breaker)
+    return {"status": "ok", "circuits": breaker_states()}
 
 
 # -----------------------------------
 # SELF-PING BACKGROUND TASK
 # -----------------------------------
 
-def self_ping_loop():
+async def self_ping_loop():
     """
     Keeps the Render service awake by pinging /health periodically.
+    The interval is jittered, and while pings fail it doubles per
+    failure up to SELF_PING_MAX_BACKOFF instead of hammering a
+    recovering service.
     """
-    time.sleep(10)
-    url = f"{SERVICE_BASE_URL}/health"
+    await asyncio.sleep(10)
+    failures = 0
 
     while True:
         try:
-            requests.get(url, timeout=ALLOWED_TIMEOUT)
+            r = await app.state.client.get(SELF_PING_URL, timeout=ALLOWED_TIMEOUT)
+            r.raise_for_status()
+            failures = 0
         except Exception:
-            pass
-        time.sleep(SELF_PING_INTERVAL)
+            failures += 1
 
+        delay = min(SELF_PING_MAX_BACKOFF, SELF_PING_INTERVAL * 2 ** failures)
+        await asyncio.sleep(delay + random.uniform(-SELF_PING_JITTER, SELF_PING_JITTER))
 
-@app.on_event("startup")
-def start_self_ping():
-    t = threading.Thread(target=self_ping_loop, daemon=True)
-    t.start()
 # -----------------------------------
-# UNIFIED PRICE ENDPOINT (STOCK/ETF/FUTURE/INDEX)
+# REFRESH-AHEAD FOR HOT SYMBOLS
 # -----------------------------------
 
-@app.get("/price/{symbol}")
-def get_price(symbol: str):
-    symbol = symbol.upper()
-    asset_type = detect_asset_type(symbol)
+_symbol_hits = Counter()
+_refreshed_at = {}
+
+
+async def refresh_ahead_loop():
+    """
+    Re-fetches the most requested symbols' charts just before their
+    cache entries expire, so clients polling them keep hitting the cache.
+    Hit counts halve every pass, so symbols nobody asks for drop out.
+    """
+    while True:
+        await asyncio.sleep(REFRESH_AHEAD_INTERVAL)
+
+        hot = [
+            symbol
+            for symbol, hits in _symbol_hits.most_common(REFRESH_AHEAD_TOP_K)
+            if hits >= REFRESH_AHEAD_MIN_HITS
+        ]
+        for symbol, hits in list(_symbol_hits.items()):
+            if hits > 1:
+                _symbol_hits[symbol] = hits // 2
+            else:
+                del _symbol_hits[symbol]
+        for symbol in list(_refreshed_at):
+            if symbol not in hot:
+                del _refreshed_at[symbol]
+
+        now = time.monotonic()
+        due = []
+        for symbol in hot:
+            if symbol in YAHOO_MISSES:
+                continue  # served from Stooq for now
+            chart = CHART_CACHE.get(symbol)
+            if chart is not None and chart.get("marketState") == "CLOSED":
+                continue  # long TTL, nothing to gain
+            if now - _refreshed_at.get(symbol, 0) >= QUOTE_TTL - REFRESH_AHEAD_MARGIN:
+                due.append(symbol)
+
+        if due:
+            client = app.state.client
+            await asyncio.gather(
+                *(fetch_yahoo_chart.refresh(client, symbol) for symbol in due),
+                return_exceptions=True,
+            )
+            for symbol in due:
+                _refreshed_at[symbol] = now
 
-    # 1) Yahoo Chart API (primary)
+
+# -----------------------------------
+# SHARED YAHOO + STOOQ LOOKUP
+# -----------------------------------
+
+def _chart_response(asset_type: str, symbol: str, chart: dict) -> dict:
+    # `chart` comes from fetch_yahoo_chart, which already defaults the
+    # history arrays to EMPTY
+    get = chart.get
+    return {
+        "source": "yahoo_chart",
+        "asset_type": asset_type,
+        "symbol": symbol,
+
+        # Real-time price
+        "price": chart["regularMarketPrice"],
+
+        # Metadata
+        "previousClose": get("previousClose"),
+        "exchangeName": get("exchangeName"),
+        "currency": get("currency"),
+        "marketState": get("marketState"),
+
+        # OHLC + volume arrays
+        "timestamps": chart["timestamps"],
+        "open": chart["open"],
+        "high": chart["high"],
+        "low": chart["low"],
+        "close": chart["close"],
+        "volume": chart["volume"],
+    }
+
+
+async def _price_for(symbol: str, asset_type: str, error: str) -> dict:
+    """
+    Price lookup behind /price, /futures and /index.
+    `symbol` must already be upper-cased.
+
+    Symbols Yahoo recently had no data for skip straight to Stooq, and
+    symbols neither source knows are answered from BAD_SYMBOLS without
+    going upstream. Network errors never land in either cache; when they
+    take out both sources, the last good answer is served with
+    "stale": true instead.
+    """
+    failure = {
+        "error": error,
+        "symbol": symbol,
+        "asset_type": asset_type,
+    }
+    if (symbol, asset_type) in BAD_SYMBOLS:
+        return failure
+
+    _symbol_hits[symbol] += 1
+    client = app.state.client
+    stq_symbol = STOOQ_SYMBOL_MAPPERS[asset_type](symbol)
+
+    # Fire both sources at once; Yahoo wins whenever it has data,
+    # so a Yahoo miss costs max(yahoo, stooq) instead of the sum.
+    stooq_task = asyncio.create_task(fetch_stooq_quote(client, stq_symbol))
+
+    # Whatever way this returns or raises (client gone, unexpected
+    # error), Stooq isn't left running unawaited; a no-op once it's done.
     try:
-        chart = fetch_yahoo_chart(symbol)
-        if chart.get("regularMarketPrice") is not None:
-            return {
-                "source": "yahoo_chart",
+        # 1) Yahoo Chart API (primary), unless it recently had nothing
+        if symbol not in YAHOO_MISSES:
+            try:
+                chart = await fetch_yahoo_chart(client, symbol)
+                if chart.get("regularMarketPrice") is not None:
+                    result = _chart_response(asset_type, symbol, chart)
+                    LAST_PRICES[(symbol, asset_type)] = result
+                    return result
+                YAHOO_MISSES[symbol] = True
+            except PROVIDER_ERRORS as e:
+                if not is_transient_error(e):
+                    YAHOO_MISSES[symbol] = True
+
+        # 2) Stooq fallback
+        try:
+            price = await stooq_task
+
+            result = {
+                "source": "stooq",
                 "asset_type": asset_type,
                 "symbol": symbol,
-
-                # Real-time price
-                "price": chart["regularMarketPrice"],
-
-                # Metadata
-                "previousClose": chart.get("previousClose"),
-                "exchangeName": chart.get("exchangeName"),
-                "currency": chart.get("currency"),
-                "marketState": chart.get("marketState"),
-
-                # OHLC + volume arrays
-                "timestamps": chart.get("timestamps", []),
-                "open": chart.get("open", []),
-                "high": chart.get("high", []),
-                "low": chart.get("low", []),
-                "close": chart.get("close", []),
-                "volume": chart.get("volume", []),
+                "stooq_symbol": stq_symbol,
+                "price": price,
             }
-    except Exception:
-        pass
+            LAST_PRICES[(symbol, asset_type)] = result
+            return result
+        except PROVIDER_ERRORS as e:
+            stooq_missed = not is_transient_error(e)
 
-    # 2) Stooq fallback
-    try:
-        if asset_type == "stock":
-            stq_symbol = stooq_symbol_for_stock(symbol)
-        elif asset_type == "future":
-            stq_symbol = stooq_symbol_for_future(symbol)
-        elif asset_type == "index":
-            stq_symbol = stooq_symbol_for_index(symbol)
-        else:
-            stq_symbol = stooq_symbol_for_stock(symbol)
+        # 3) Total failure
+        if stooq_missed and symbol in YAHOO_MISSES:
+            BAD_SYMBOLS[(symbol, asset_type)] = True
+            return failure
+
+        last = LAST_PRICES.get((symbol, asset_type))
+        if last is not None:
+            return {**last, "stale": True}
+        return failure
+    finally:
+        cancel_quietly(stooq_task)
+
+
+def _conditional_response(request: Request, result: dict):
+    """
+    Serve a price result with a weak ETag and PRICE_CACHE_CONTROL,
+    answering 304 when the client already has it. Errors and stale
+    fallbacks go out uncached.
+    """
+    if "error" in result or result.get("stale"):
+        return result
+
+    body = orjson.dumps(result)
+    etag = 'W/"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+    headers = {"ETag": etag, "Cache-Control": PRICE_CACHE_CONTROL}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-        price = fetch_stooq_quote(stq_symbol)
 
-        return {
-            "source": "stooq",
-            "asset_type": asset_type,
+# -----------------------------------
+# UNIFIED PRICE ENDPOINT (STOCK/ETF/FUTURE/INDEX)
+# -----------------------------------
+
+@app.get("/price/{symbol}")
+async def get_price(symbol: str, request: Request):
+    symbol = symbol.upper()
+    result = await _price_for(
+        symbol, detect_asset_type(symbol), "Invalid symbol or no data available"
+    )
+    return _conditional_response(request, result)
+
+
+# -----------------------------------
+# BATCH PRICE ENDPOINT
+# -----------------------------------
+
+@app.get("/prices")
+async def get_prices(
+    symbols: str = Query(..., description="Comma-separated symbols, e.g. AAPL,MSFT,^GSPC"),
+):
+    wanted = list(dict.fromkeys(s.strip().upper() for s in symbols.split(",") if s.strip()))
+    if not wanted:
+        raise HTTPException(status_code=400, detail="No symbols given")
+    if len(wanted) > MAX_BATCH_SYMBOLS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_SYMBOLS} symbols per request",
+        )
+
+    charts = await multi_fetch_yahoo_quote(app.state.client, wanted)
+
+    results = []
+    for symbol in wanted:
+        chart = charts.get(symbol)
+        if chart is None or chart.get("regularMarketPrice") is None:
+            results.append({
+                "error": "Invalid symbol or no data available",
+                "symbol": symbol,
+                "asset_type": detect_asset_type(symbol),
+            })
+            continue
+
+        results.append({
+            "source": "yahoo_chart",
+            "asset_type": detect_asset_type(symbol),
             "symbol": symbol,
-            "stooq_symbol": stq_symbol,
-            "price": price,
-        }
-    except Exception:
-        pass
+            "price": chart["regularMarketPrice"],
+            "previousClose": chart.get("previousClose"),
+            "exchangeName": chart.get("exchangeName"),
+            "currency": chart.get("currency"),
+            "marketState": chart.get("marketState"),
+        })
+
+    return {"results": results}
+
 
-    # 3) Total failure
-    return {
-        "error": "Invalid symbol or no data available",
-        "symbol": symbol,
-        "asset_type": asset_type,
-    }
 # -----------------------------------
 # CRYPTO ENDPOINT
 # -----------------------------------
 
 @app.get("/crypto/{symbol}")
-def crypto_price(symbol: str):
+async def crypto_price(symbol: str):
     symbol = symbol.lower()
     try:
-        return fetch_crypto_price(symbol)
-    except Exception as e:
+        return await fetch_crypto_price(app.state.client, symbol)
+    except PROVIDER_ERRORS as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.get("/crypto")
+async def crypto_prices(
+    ids: str = Query(..., description="Comma-separated CoinGecko ids, e.g. bitcoin,ethereum"),
+):
+    wanted = list(dict.fromkeys(i.strip().lower() for i in ids.split(",") if i.strip()))
+    if not wanted:
+        raise HTTPException(status_code=400, detail="No ids given")
+    if len(wanted) > MAX_BATCH_SYMBOLS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_SYMBOLS} ids per request",
+        )
+
+    # Uncached ids go out together in one CoinGecko request
+    prices = await asyncio.gather(
+        *(fetch_crypto_price(app.state.client, coin_id) for coin_id in wanted),
+        return_exceptions=True,
+    )
+
+    results = []
+    for coin_id, price in zip(wanted, prices):
+        if isinstance(price, PROVIDER_ERRORS):
+            results.append({"error": str(price), "symbol": coin_id.upper()})
+        elif isinstance(price, Exception):
+            raise price
+        else:
+            results.append(price)
+
+    return {"results": results}
+
+
 # -----------------------------------
 # FUTURES ENDPOINT
 # -----------------------------------
 
 @app.get("/futures/{symbol}")
-def futures_price(symbol: str):
-    symbol = symbol.upper()
-
-    try:
-        # Yahoo Chart API first
-        chart = fetch_yahoo_chart(symbol)
-        if chart.get("regularMarketPrice") is not None:
-            return {
-                "source": "yahoo_chart",
-                "asset_type": "future",
-                "symbol": symbol,
-                "price": chart["regularMarketPrice"],
-                "previousClose": chart.get("previousClose"),
-                "exchangeName": chart.get("exchangeName"),
-                "currency": chart.get("currency"),
-                "marketState": chart.get("marketState"),
-                "timestamps": chart.get("timestamps", []),
-                "open": chart.get("open", []),
-                "high": chart.get("high", []),
-                "low": chart.get("low", []),
-                "close": chart.get("close", []),
-                "volume": chart.get("volume", []),
-            }
-    except Exception:
-        pass
-
-    # Stooq fallback
-    try:
-        stq_symbol = stooq_symbol_for_future(symbol)
-        price = fetch_stooq_quote(stq_symbol)
-        return {
-            "source": "stooq",
-            "asset_type": "future",
-            "symbol": symbol,
-            "stooq_symbol": stq_symbol,
-            "price": price,
-        }
-    except Exception:
-        pass
-
-    return {"error": "Invalid future symbol", "symbol": symbol}
+async def futures_price(symbol: str, request: Request):
+    result = await _price_for(symbol.upper(), "future", "Invalid future symbol")
+    return _conditional_response(request, result)
 
 
 # -----------------------------------
@@ -263,44 +524,6 @@ def futures_price(symbol: str):
 # -----------------------------------
 
 @app.get("/index/{symbol}")
-def index_price(symbol: str):
-    symbol = symbol.upper()
-
-    try:
-        # Yahoo Chart API first
-        chart = fetch_yahoo_chart(symbol)
-        if chart.get("regularMarketPrice") is not None:
-            return {
-                "source": "yahoo_chart",
-                "asset_type": "index",
-                "symbol": symbol,
-                "price": chart["regularMarketPrice"],
-                "previousClose": chart.get("previousClose"),
-                "exchangeName": chart.get("exchangeName"),
-                "currency": chart.get("currency"),
-                "marketState": chart.get("marketState"),
-                "timestamps": chart.get("timestamps", []),
-                "open": chart.get("open", []),
-                "high": chart.get("high", []),
-                "low": chart.get("low", []),
-                "close": chart.get("close", []),
-                "volume": chart.get("volume", []),
-            }
-    except Exception:
-        pass
-
-    # Stooq fallback
-    try:
-        stq_symbol = stooq_symbol_for_index(symbol)
-        price = fetch_stooq_quote(stq_symbol)
-        return {
-            "source": "stooq",
-            "asset_type": "index",
-            "symbol": symbol,
-            "stooq_symbol": stq_symbol,
-            "price": price,
-        }
-    except Exception:
-        pass
-
-    return {"error": "Invalid index symbol", "symbol": symbol}
+async def index_price(symbol: str, request: Request):
+    result = await _price_for(symbol.upper(), "index", "Invalid index symbol")
+    return _conditional_response(request, result)
@@ -0,0 +1,71 @@
+import asyncio
+
+import httpx
+import pytest
+
+import core
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    core._breakers.clear()
+    yield
+    core._breakers.clear()
+
+
+def make_fetcher(requests, status=200, body=b"{}"):
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(status, content=body)
+
+    @core.circuit_breaker("test", 1.0)
+    async def fetch(client):
+        return await core.get_json(client, "https://provider.test/quote")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client, fetch
+
+
+def call_repeatedly(client, fetch, times):
+    async def run():
+        results = []
+        for _ in range(times):
+            try:
+                results.append(await fetch(client))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    return asyncio.run(run())
+
+
+def test_opens_after_fail_max_transient_failures():
+    requests = []
+    client, fetch = make_fetcher(requests, status=503)
+
+    results = call_repeatedly(client, fetch, core.BREAKER_FAIL_MAX + 2)
+    assert len(requests) == core.BREAKER_FAIL_MAX
+    assert all(
+        isinstance(r, httpx.HTTPStatusError) for r in results[: core.BREAKER_FAIL_MAX]
+    )
+    assert all(isinstance(r, core.CircuitOpen) for r in results[core.BREAKER_FAIL_MAX :])
+    assert core.breaker_states()["test"]["state"] == "open"
+
+
+def test_no_data_does_not_count():
+    requests = []
+    client, fetch = make_fetcher(requests, body=b"not json")
+
+    results = call_repeatedly(client, fetch, core.BREAKER_FAIL_MAX + 2)
+    assert len(requests) == core.BREAKER_FAIL_MAX + 2
+    assert all(isinstance(r, core.NoData) for r in results)
+    assert "test" not in core.breaker_states()
+
+
+def test_success_closes_the_circuit():
+    requests = []
+    client, fetch = make_fetcher(requests)
+    core._breakers["test"] = [core.BREAKER_FAIL_MAX - 1, 0.0]
+
+    assert call_repeatedly(client, fetch, 1) == [{}]
+    assert core.breaker_states() == {}
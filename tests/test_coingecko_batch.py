@@ -0,0 +1,73 @@
+import asyncio
+
+import httpx
+import pytest
+
+import core
+from cache import CRYPTO_CACHE
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    CRYPTO_CACHE.clear()
+    core._breakers.clear()
+    core._coingecko_batch = None
+    yield
+    CRYPTO_CACHE.clear()
+    core._coingecko_batch = None
+
+
+def make_client(requests):
+    def handler(request):
+        ids = request.url.params["ids"].split(",")
+        requests.append(ids)
+        return httpx.Response(200, json={i: {"usd": 1.5} for i in ids if i != "nope"})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_concurrent_lookups_share_one_request():
+    requests = []
+
+    async def run():
+        client = make_client(requests)
+        return await asyncio.gather(
+            *(core.fetch_crypto_price(client, s) for s in ["btc", "eth", "nope", "BTC"]),
+            return_exceptions=True,
+        )
+
+    btc, eth, nope, btc_again = asyncio.run(run())
+    assert requests == [["btc", "eth", "nope"]]
+    assert btc["price"] == eth["price"] == btc_again["price"] == 1.5
+    assert isinstance(nope, core.NoData)
+
+
+def test_cancelled_waiter_does_not_poison_the_batch():
+    requests = []
+
+    async def run():
+        client = make_client(requests)
+        first = asyncio.create_task(core.fetch_crypto_price(client, "bitcoin"))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0.005)  # still inside the batch window
+        return await core.fetch_crypto_price(client, "bitcoin")
+
+    assert asyncio.run(run())["price"] == 1.5
+    assert requests == [["bitcoin"]]
+
+
+def test_full_batch_is_sent_without_waiting_for_the_window(monkeypatch):
+    monkeypatch.setattr(core, "COINGECKO_BATCH_WINDOW", 30)
+    requests = []
+
+    async def run():
+        client = make_client(requests)
+        coin_ids = [f"coin{i}" for i in range(core.COINGECKO_BATCH_MAX)]
+        return await asyncio.wait_for(
+            asyncio.gather(*(core.fetch_crypto_price(client, c) for c in coin_ids)),
+            timeout=2,
+        )
+
+    assert len(asyncio.run(run())) == core.COINGECKO_BATCH_MAX
+    assert len(requests) == 1
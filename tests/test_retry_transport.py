@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import httpx
+
+import core
+
+
+def make_client(requests, responses):
+    def handler(request):
+        requests.append(request.url.path)
+        return responses.pop(0)
+
+    transport = core.RetryTransport(httpx.MockTransport(handler))
+    return httpx.AsyncClient(transport=transport)
+
+
+def timed_get(client, **kwargs):
+    async def run():
+        start = time.monotonic()
+        r = await client.get("https://provider.test/quote", **kwargs)
+        return r, time.monotonic() - start
+
+    return asyncio.run(run())
+
+
+def test_retry_after_is_honoured():
+    requests = []
+    client = make_client(requests, [
+        httpx.Response(429, headers={"Retry-After": "0.2"}),
+        httpx.Response(200, json={}),
+    ])
+
+    r, elapsed = timed_get(client)
+    assert r.status_code == 200
+    assert len(requests) == 2
+    # Retry-After, not the RETRY_BACKOFF default
+    assert 0.2 <= elapsed < core.RETRY_BACKOFF
+
+
+def test_long_retry_after_is_handed_back():
+    requests = []
+    client = make_client(requests, [
+        httpx.Response(503, headers={"Retry-After": str(core.RETRY_MAX_WAIT + 60)}),
+    ])
+
+    r, elapsed = timed_get(client)
+    assert r.status_code == 503
+    assert len(requests) == 1
+    assert elapsed < core.RETRY_BACKOFF
+
+
+def test_no_retry_request_is_sent_once():
+    requests = []
+    client = make_client(requests, [
+        httpx.Response(503, headers={"Retry-After": "0"}),
+        httpx.Response(200, json={}),
+    ])
+
+    r, _ = timed_get(client, extensions=core.NO_RETRY)
+    assert r.status_code == 503
+    assert len(requests) == 1
@@ -0,0 +1,86 @@
+import asyncio
+
+import httpx
+from cachetools import TTLCache
+
+from cache import ttl_cached
+from core import get_json
+
+
+def make_fetcher(requests, cancelled, delay=0.05):
+    async def handler(request):
+        requests.append(request.url.params["s"])
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(request.url.params["s"])
+            raise
+        return httpx.Response(200, json={"price": 1.5})
+
+    @ttl_cached(TTLCache(16, ttl=60))
+    async def fetch_price(client, symbol):
+        return await get_json(client, f"https://quotes.test/?s={symbol}")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client, fetch_price
+
+
+def test_concurrent_misses_share_one_request():
+    requests, cancelled = [], []
+
+    async def run():
+        client, fetch_price = make_fetcher(requests, cancelled)
+        results = await asyncio.gather(
+            *(fetch_price(client, s) for s in ["aapl", "AAPL", "aapl"])
+        )
+        return results, await fetch_price(client, "aapl")
+
+    results, cached = asyncio.run(run())
+    assert requests == ["aapl"]
+    assert results == [{"price": 1.5}] * 3
+    assert cached == {"price": 1.5}
+
+
+def test_cancelled_sole_waiter_cancels_the_fetch():
+    requests, cancelled = [], []
+
+    async def run():
+        client, fetch_price = make_fetcher(requests, cancelled)
+        waiter = asyncio.create_task(fetch_price(client, "aapl"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        return await fetch_price(client, "aapl")
+
+    assert asyncio.run(run()) == {"price": 1.5}
+    assert cancelled == ["aapl"]
+    assert requests == ["aapl", "aapl"]
+
+
+def test_one_of_two_waiters_leaving_keeps_the_fetch():
+    requests, cancelled = [], []
+
+    async def run():
+        client, fetch_price = make_fetcher(requests, cancelled)
+        leaving = asyncio.create_task(fetch_price(client, "aapl"))
+        staying = asyncio.create_task(fetch_price(client, "aapl"))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        return await staying
+
+    assert asyncio.run(run()) == {"price": 1.5}
+    assert cancelled == []
+    assert requests == ["aapl"]
+
+
+def test_refresh_joins_a_fetch_in_flight():
+    requests, cancelled = [], []
+
+    async def run():
+        client, fetch_price = make_fetcher(requests, cancelled)
+        return await asyncio.gather(
+            fetch_price(client, "aapl"), fetch_price.refresh(client, "aapl")
+        )
+
+    assert asyncio.run(run()) == [{"price": 1.5}] * 2
+    assert requests == ["aapl"]